@@ -1,5 +1,6 @@
 import logging
 import os.path
+import re
 import shutil
 import subprocess
 import sys
@@ -17,6 +18,13 @@ from kzam.download import Downloader
 from kzam.log import get_logger
 
 
+# Matches the "id" and "path" lines in the output of `kiwix-manage show`
+ZIM_SHOW_FIELD_RE = re.compile(rb"^[ \t]*(id|path):[ \t]*(\S.*?)[ \t\r]*$", re.MULTILINE)
+
+# Sentinel distinguishing a missing dict key from a key mapped to None
+_MISSING = object()
+
+
 def parse_date(s: str) -> date:
     """Convert a date in the format "YYYY-MM" to a `date` object (using 1 for the `day` value)."""
     y, m = s.split("-")
@@ -50,6 +58,18 @@ def bytes_to_str(b: int) -> str:
             return f"{div} {suf.name}"
     return f"{b} B"
 
+def parse_zim_ids(output: bytes) -> dict[str, str]:
+    """Parse the output of `kiwix-manage show` into a map of archive paths to ZIM IDs."""
+    zim_ids: dict[str, str] = {}
+    latest_id: Optional[bytes] = None
+    for m in ZIM_SHOW_FIELD_RE.finditer(output):
+        key, value = m.groups()
+        if key == b"id":
+            latest_id = value
+        elif latest_id is not None:
+            zim_ids.setdefault(value.decode(), latest_id.decode())
+    return zim_ids
+
 
 class ArchiveManager:
 
@@ -59,12 +79,23 @@ class ArchiveManager:
         # Lazy initiate these as they may not be needed depending on the subcommands run
         self._db_manager: Optional[DbManager] = None
         self._dl_manager: Optional[Downloader] = None
-        if os.path.isfile(config.base_dir):
-            raise FileExistsError(f"Already a non-directory file at {config.base_dir}.")
-        if os.path.isfile(config.archive_dir):
-            raise FileExistsError(f"Already a non-directory file at {config.archive_dir}.")
-        if not os.path.exists(config.archive_dir):
-            os.makedirs(config.archive_dir)
+        # Map of archive paths to ZIM IDs in the library, populated on first use and reset when the library changes
+        self._zim_ids: Optional[dict[str, str]] = None
+        self._dirs_checked = False
+
+    def _ensure_dirs(self):
+        """Check that the base and archive directories can be used, creating them if necessary. This is done on first
+        use rather than on initialisation, as some subcommands (eg, search) don't touch the filesystem.
+        """
+        if self._dirs_checked:
+            return
+        if os.path.isfile(self.config.base_dir):
+            raise FileExistsError(f"Already a non-directory file at {self.config.base_dir}.")
+        if os.path.isfile(self.config.archive_dir):
+            raise FileExistsError(f"Already a non-directory file at {self.config.archive_dir}.")
+        if not os.path.exists(self.config.archive_dir):
+            os.makedirs(self.config.archive_dir)
+        self._dirs_checked = True
 
     @property
     def dl_manager(self) -> Downloader:
@@ -75,34 +106,50 @@ class ArchiveManager:
     @property
     def db_manager(self) -> DbManager:
         if self._db_manager is None:
+            self._ensure_dirs()
             self._db_manager = DbManager(self.config.db_path)
         return self._db_manager
 
+    @property
+    def zim_ids(self) -> dict[str, str]:
+        if self._zim_ids is None:
+            output = subprocess.run(
+                [self.config.kiwix_manage_exec, self.config.library_path, "show"],
+                capture_output=True
+            ).stdout
+            self._zim_ids = parse_zim_ids(output)
+        return self._zim_ids
+
+    def add_many_to_library(self, archives: Collection[ArchiveDetails]):
+        """Add several archives to the library with a single call to kiwix-manage."""
+        if not archives:
+            return
+        archive_paths = [os.path.join(self.config.archive_dir, a.file_name) for a in archives]
+        subprocess.run([self.config.kiwix_manage_exec, self.config.library_path, "add", *archive_paths])
+        self._zim_ids = None
+
     def add_to_library(self, archive: ArchiveDetails):
-        archive_path = os.path.join(self.config.archive_dir, archive.file_name)
-        subprocess.run([self.config.kiwix_manage_exec, self.config.library_path, "add", archive_path])
+        self.add_many_to_library([archive])
 
     def get_zim_id(self, archive: ArchiveDetails) -> Optional[str]:
-        output = subprocess.run(
-            [self.config.kiwix_manage_exec, self.config.library_path, "show"],
-            capture_output=True
-        ).stdout.decode()
         relevant_path = os.path.join(self.config.archive_dir, archive.file_name)
-        lines = output.splitlines()
-        latest_id: Optional[str] = None
-        for line in lines:
-            line = line.strip()
-            if line.startswith("id:"):
-                latest_id = line.split()[1]
-            elif line.startswith("path:"):
-                if line.split()[1] == relevant_path:
-                    return latest_id
-        return None
+        return self.zim_ids.get(relevant_path)
+
+    def remove_many_from_library(self, archives: Collection[ArchiveDetails]):
+        """Remove several archives from the library with a single call to kiwix-manage. Archives that are not in the
+        library are ignored.
+        """
+        archive_paths = [os.path.join(self.config.archive_dir, a.file_name) for a in archives]
+        zim_ids = [self.zim_ids[p] for p in archive_paths if p in self.zim_ids]
+        if not zim_ids:
+            return
+        subprocess.run([self.config.kiwix_manage_exec, self.config.library_path, "remove", *zim_ids])
+        # Only the removed archives' entries are now stale, so no need to re-read the whole library
+        for p in archive_paths:
+            self.zim_ids.pop(p, None)
 
     def remove_from_library(self, archive: ArchiveDetails):
-        zim_id = self.get_zim_id(archive)
-        if zim_id is not None:
-            subprocess.run([self.config.kiwix_manage_exec, self.config.library_path, "remove", zim_id])
+        self.remove_many_from_library([archive])
 
     def get_new(self) -> tuple[list[ArchiveEntry], list[ArchiveDetails]]:
         # Map archive references to archive details
@@ -124,13 +171,19 @@ class ArchiveManager:
         lang: set[str] = set()
         for r in archive_refs:
             lang |= r.language
+        # Most entries from the server won't match any configured archive, so check name and flavour first, which is
+        # cheaper than constructing and hashing a full reference for each entry
+        names_flavours: set[tuple[str, Optional[str]]] = {(r.name, r.flavour) for r in archive_refs}
         from_server = self.dl_manager.search(lang)
         new: list[ArchiveEntry] = []
         for e in from_server:
-            ref = e.to_reference()
-            if ref in archive_refs:
-                if (archive_refs[ref] is None) or (archive_refs[ref].updated < e.updated):
-                    new.append(e)
+            if (e.name, e.flavor) not in names_flavours:
+                continue
+            existing = archive_refs.get(e.to_reference(), _MISSING)
+            if existing is _MISSING:
+                continue
+            if (existing is None) or (existing.updated < e.updated):
+                new.append(e)
         return new, to_delete
 
     def get_archive_configs(
@@ -141,7 +194,16 @@ class ArchiveManager:
     ) -> str:
         return "\n\n".join((e.to_reference().to_config() for e in self.dl_manager.search(lang, category, query)))
 
+    def delete_files(self, archives: Collection[ArchiveDetails]):
+        """Delete the files of the given archives from the archive directory, if they exist."""
+        for a in archives:
+            fpath = os.path.join(self.config.archive_dir, a.file_name)
+            if os.path.exists(fpath):
+                self.logger.info(f"Deleting file at {fpath}.")
+                os.remove(fpath)
+
     def update(self, prompt: bool = False, quiet: bool = False):
+        self._ensure_dirs()
         to_download, to_delete = self.get_new()
         self.logger.info(f"Found {len(to_download)} updated archives to download.")
         if to_download:
@@ -153,20 +215,22 @@ class ArchiveManager:
                     self.logger.info("Aborting.")
                     return
             downloaded = self.dl_manager.download_all(to_download, quiet=quiet)
-            for d in downloaded:
-                self.db_manager.insert_archive(d)
-                self.add_to_library(d)
+            superseded = self.db_manager.insert_archives(downloaded)
+            # Don't touch an old version's file if the new version was downloaded to the same path
+            new_files = {d.file_name for d in downloaded}
+            superseded = [d for d in superseded if d.file_name not in new_files]
+            if superseded:
+                self.logger.info(f"{len(superseded)} old versions of archives will be deleted.")
+                self.delete_files(superseded)
+                self.remove_many_from_library(superseded)
+            self.add_many_to_library(downloaded)
         else:
             self.logger.info("Nothing to download.")
         if to_delete:
             self.logger.info(f"{len(to_delete)} archives will be deleted as they no longer appear in the configuration file.")
-            for d in to_delete:
-                fpath = os.path.join(self.config.archive_dir, d.file_name)
-                if os.path.exists(fpath):
-                    self.logger.info(f"Deleting file at {fpath}.")
-                    os.remove(fpath)
-                self.db_manager.delete_archive(d)
-                self.remove_from_library(d)
+            self.delete_files(to_delete)
+            self.remove_many_from_library(to_delete)
+            self.db_manager.delete_archives(to_delete)
 
 
 def main():
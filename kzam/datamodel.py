@@ -1,10 +1,10 @@
 import sqlite3
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from datetime import datetime
 from typing import Optional
 from xml.etree.ElementTree import Element
 
-from kzam.xml_utils import ENTRIES_NSMAP, META_NSMAP
+from kzam.xml_utils import ENTRIES_NSMAP, META_NSMAP, ATOM_PREFIX
 
 
 @dataclass(eq=True, frozen=True)
@@ -34,27 +34,34 @@ class ArchiveEntry:
 
     @classmethod
     def from_xml(cls, elem: Element) -> "ArchiveEntry":
-        #print(list(elem))
-        for link in elem.findall("atom:link", ENTRIES_NSMAP):
-            if link.attrib["type"] == "application/x-zim":
-                meta_link = link.attrib["href"]
-                break
-        else:
+        # Collect the text of each child element in a single pass, rather than searching for each one separately
+        text: dict[str, Optional[str]] = {}
+        meta_link: Optional[str] = None
+        for child in elem:
+            tag = child.tag.removeprefix(ATOM_PREFIX)
+            if tag == "link":
+                if (meta_link is None) and (child.attrib.get("type") == "application/x-zim"):
+                    meta_link = child.attrib["href"]
+            elif tag in ("author", "publisher"):
+                text[tag] = child.find("atom:name", ENTRIES_NSMAP).text
+            else:
+                text[tag] = child.text
+        if meta_link is None:
             raise ValueError("Could not find meta link.")
         return cls(
-            elem.find("atom:id", ENTRIES_NSMAP).text,
-            elem.find("atom:title", ENTRIES_NSMAP).text,
-            datetime.fromisoformat(elem.find("atom:updated", ENTRIES_NSMAP).text),
-            elem.find("atom:summary", ENTRIES_NSMAP).text,
-            frozenset(elem.find("atom:language", ENTRIES_NSMAP).text.split(",")),
-            elem.find("atom:name", ENTRIES_NSMAP).text,
-            elem.find("atom:flavour", ENTRIES_NSMAP).text or None,
-            elem.find("atom:category", ENTRIES_NSMAP).text or None,
-            frozenset(elem.find("atom:tags", ENTRIES_NSMAP).text.split(";")),
-            int(elem.find("atom:articleCount", ENTRIES_NSMAP).text),
-            int(elem.find("atom:mediaCount", ENTRIES_NSMAP).text),
-            elem.find("atom:author", ENTRIES_NSMAP).find("atom:name", ENTRIES_NSMAP).text,
-            elem.find("atom:publisher", ENTRIES_NSMAP).find("atom:name", ENTRIES_NSMAP).text,
+            text["id"],
+            text["title"],
+            datetime.fromisoformat(text["updated"]),
+            text["summary"],
+            frozenset(text["language"].split(",")),
+            text["name"],
+            text["flavour"] or None,
+            text["category"] or None,
+            frozenset(text["tags"].split(";")),
+            int(text["articleCount"]),
+            int(text["mediaCount"]),
+            text["author"],
+            text["publisher"],
             meta_link
         )
 
@@ -67,6 +74,16 @@ class ArchiveReference:
     name: str
     language: frozenset[str]
     flavour: str
+    # Derived values, computed once on construction as references are frequently hashed and written to the database
+    language_str: str = field(init=False, repr=False, compare=False)
+    _hash: int = field(init=False, repr=False, compare=False)
+
+    def __post_init__(self):
+        object.__setattr__(self, "language_str", ",".join(sorted(self.language)))
+        object.__setattr__(self, "_hash", hash((self.name, self.language, self.flavour)))
+
+    def __hash__(self) -> int:
+        return self._hash
 
     def to_file_name(self, updated: Optional[datetime] = None) -> str:
         if updated is None:
@@ -78,7 +95,7 @@ class ArchiveReference:
         lines = [
             "[[archive]]",
             f'name = "{self.name}"',
-            f'language = "{','.join(self.language)}"'
+            f'language = "{self.language_str}"'
         ]
         if self.flavour:
             lines.append(f'flavour = "{self.flavour}"')
@@ -102,7 +119,7 @@ class ArchiveDetails:
         )
         return cls(
             reference=reference,
-            updated=datetime.fromisoformat(row["updated"]),
+            updated=row["updated"],
             file_name=row["file_name"]
         )
 
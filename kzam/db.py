@@ -5,6 +5,7 @@ from kzam.datamodel import ArchiveReference, ArchiveDetails
 
 sqlite3.register_adapter(date, lambda d: d.strftime("%Y-%m-%d"))
 sqlite3.register_converter("DATE", lambda b: datetime.strptime(b.decode(), "%Y-%m-%d").date())
+sqlite3.register_converter("DATETIME", lambda b: datetime.fromisoformat(b.decode()))
 
 
 class DbManager:
@@ -39,6 +40,22 @@ class DbManager:
         VALUES (?, ?, ?, ?, ?)
     """
 
+    SELECT_SUPERSEDED = """
+        SELECT * FROM archives
+        WHERE
+            name = ?
+            AND language = ?
+            AND flavour IS ?
+    """
+
+    DELETE_SUPERSEDED = """
+        DELETE FROM archives
+        WHERE
+            name = ?
+            AND language = ?
+            AND flavour IS ?
+    """
+
     SELECT_OLDER = """
         SELECT * FROM archives
         WHERE
@@ -53,7 +70,7 @@ class DbManager:
         WHERE
             name = ?
             AND language = ?
-            AND flavour = ?
+            AND flavour IS ?
             AND updated = ?
     """
 
@@ -72,6 +89,9 @@ class DbManager:
         self.db_path = db_path
         self.conn = sqlite3.connect(db_path, detect_types=sqlite3.PARSE_DECLTYPES)
         self.conn.row_factory = sqlite3.Row
+        # In WAL mode, commits only need to sync the log, and NORMAL synchronisation is still safe against corruption
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
         self.create_table()
 
     def create_table(self):
@@ -82,7 +102,7 @@ class DbManager:
         with self.conn:
             result = self.conn.execute(
                 self.SELECT_ARCHIVES,
-                (ref.name, ",".join(sorted(ref.language)), ref.flavour)
+                (ref.name, ref.language_str, ref.flavour)
             )
         return [ArchiveDetails.from_row(r) for r in result]
 
@@ -97,7 +117,7 @@ class DbManager:
         with self.conn:
             return bool(self.conn.execute(self.ARCHIVE_EXISTS, (
                 ref.name,
-                ",".join(sorted(ref.language)),
+                ref.language_str,
                 ref.flavour,
                 updated
             )).fetchone()[0])
@@ -106,16 +126,26 @@ class DbManager:
         with self.conn:
             return [ArchiveDetails.from_row(r) for r in self.conn.execute(self.SELECT_OLDER, (
                 ref.name,
-                ",".join(sorted(ref.language)),
+                ref.language_str,
                 ref.flavour,
                 older_than
             ))]
 
+    def delete_archives(self, archives: list[ArchiveDetails]):
+        """Delete several archives in a single transaction."""
+        with self.conn:
+            self.conn.executemany(self.DELETE_ARCHIVE, [(
+                a.reference.name,
+                a.reference.language_str,
+                a.reference.flavour,
+                a.updated
+            ) for a in archives])
+
     def delete_archive(self, archive: ArchiveDetails):
         with self.conn:
             self.conn.execute(self.DELETE_ARCHIVE, (
                 archive.reference.name,
-                ",".join(sorted(archive.reference.language)),
+                archive.reference.language_str,
                 archive.reference.flavour,
                 archive.updated
             ))
@@ -124,8 +154,31 @@ class DbManager:
         with self.conn:
             self.conn.execute(self.INSERT_ARCHIVE, (
                 archive.reference.name,
-                ",".join(sorted(archive.reference.language)),
+                archive.reference.language_str,
                 archive.reference.flavour,
                 archive.updated,
                 archive.file_name
             ))
+
+    def insert_archives(self, archives: list[ArchiveDetails]) -> list[ArchiveDetails]:
+        """Insert several archives in a single transaction, replacing any existing rows for the same archives (ie,
+        older versions of them). The replaced rows are returned so that the caller can clean up their files.
+        """
+        # `IS` rather than `=` so that archives without a flavour are matched too (NULLs don't conflict on the
+        # primary key, so INSERT OR REPLACE wouldn't catch them)
+        keys = [(a.reference.name, a.reference.language_str, a.reference.flavour) for a in archives]
+        with self.conn:
+            superseded = [
+                ArchiveDetails.from_row(r)
+                for k in keys
+                for r in self.conn.execute(self.SELECT_SUPERSEDED, k)
+            ]
+            self.conn.executemany(self.DELETE_SUPERSEDED, keys)
+            self.conn.executemany(self.INSERT_ARCHIVE, [(
+                a.reference.name,
+                a.reference.language_str,
+                a.reference.flavour,
+                a.updated,
+                a.file_name
+            ) for a in archives])
+        return superseded
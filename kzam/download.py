@@ -1,20 +1,109 @@
 import hashlib
+import io
 import os
-import urllib.parse
+import shutil
 import xml.etree.ElementTree as ET
 from concurrent.futures import ThreadPoolExecutor
-from hashlib import sha256, sha1, md5
+from contextlib import contextmanager
+from functools import partial
 from logging import Logger
 from threading import RLock
-from typing import Optional, Collection
+from typing import Optional, Collection, Callable, BinaryIO, Iterator
+from uuid import uuid4
 
 import psutil
 import requests
+from requests.adapters import HTTPAdapter
 from tqdm import tqdm
+from urllib3.util.retry import Retry
+
+try:
+    from blake3 import blake3
+except ImportError:
+    blake3 = None
 
 from kzam import Config, ArchiveDetails
 from kzam.datamodel import ArchiveEntry, ArchiveMeta, Mirror
-from kzam.xml_utils import ENTRIES_NSMAP
+from kzam.xml_utils import ATOM_PREFIX
+
+# Supported hash algorithms, in order of preference, mapped from their names in the metalink file to functions that
+# construct a new hash object. An OpenSSL-backed SHA-256 uses the CPU's SHA extensions where available, which makes it
+# faster than SHA-1 or MD5 as well as more secure. BLAKE3, if the optional blake3 package is installed, is faster still.
+HASH_ALGORITHMS: dict[str, Callable] = {}
+if blake3 is not None:
+    HASH_ALGORITHMS["blake3"] = blake3
+HASH_ALGORITHMS.update({
+    "sha-256": partial(hashlib.new, "sha256", usedforsecurity=False),
+    "sha-1": partial(hashlib.new, "sha1", usedforsecurity=False),
+    "md5": partial(hashlib.new, "md5", usedforsecurity=False),
+})
+
+# Size of the buffer used when hashing a file on disk.
+HASH_BUFSIZE = 8 * 1024 * 1024
+
+# Size of the buffer used when copying downloaded content to disk.
+COPY_BUFSIZE = 4 * 1024 * 1024
+
+
+def choose_hash(hashes: dict[str, str]) -> tuple[str, str]:
+    """Choose the preferred supported algorithm from the given hashes, returning its name and the expected digest."""
+    for algo in HASH_ALGORITHMS:
+        if algo in hashes:
+            return algo, hashes[algo]
+    raise ValueError("No supported hash found.")
+
+@contextmanager
+def open_for_download(dst_path: str) -> Iterator[BinaryIO]:
+    """Open a file for writing which is only moved into place at `dst_path` once writing completes successfully.
+
+    On Linux, the file is created anonymously using `O_TMPFILE` and linked into place at the end, so nothing is left
+    in the directory if the download is interrupted. Elsewhere (or if the filesystem doesn't support `O_TMPFILE`, or
+    `/proc` isn't mounted so the file can't be linked), a ".part" file is written alongside the destination and then
+    renamed, or removed if an exception is raised while writing.
+    """
+    dst_dir, dst_name = os.path.split(dst_path)
+    fd: Optional[int] = None
+    if hasattr(os, "O_TMPFILE") and os.path.isdir("/proc/self/fd"):
+        try:
+            fd = os.open(dst_dir or ".", os.O_TMPFILE | os.O_WRONLY, 0o644)
+        except OSError:
+            pass
+    if fd is None:
+        part_path = dst_path + ".part"
+        # Opened outside the try block, so that a failure to open isn't masked by a failure to remove
+        f = open(part_path, "wb")
+        try:
+            with f:
+                yield f
+        except BaseException:
+            os.remove(part_path)
+            raise
+        os.rename(part_path, dst_path)
+        return
+    with open(fd, "wb") as f:
+        yield f
+        f.flush()
+        # Passing a directory fd makes os.link use linkat with AT_SYMLINK_FOLLOW, which is needed to link the file
+        # that /proc/self/fd/N points to rather than the magic link itself
+        dir_fd = os.open(dst_dir or ".", os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            fd_path = f"/proc/self/fd/{fd}"
+            try:
+                os.link(fd_path, dst_name, dst_dir_fd=dir_fd, follow_symlinks=True)
+            except FileExistsError:
+                # Links can't overwrite, so link to a temporary name and rename that over the existing file. The
+                # name is random so that it can't clash with a temporary file left over from a crash.
+                while True:
+                    tmp_name = f"{dst_name}.{uuid4().hex}.tmp"
+                    try:
+                        os.link(fd_path, tmp_name, dst_dir_fd=dir_fd, follow_symlinks=True)
+                        break
+                    except FileExistsError:
+                        continue
+                os.replace(tmp_name, dst_name, src_dir_fd=dir_fd, dst_dir_fd=dir_fd)
+        finally:
+            os.close(dir_fd)
+
 
 class DownloadError(Exception):
     pass
@@ -26,26 +115,57 @@ class MirrorDownloadFailed(DownloadError):
     """Could not download a file from a specific mirror."""
     pass
 
+class ProgressReader(io.RawIOBase):
+    """Wrapper around a readable binary stream that updates a progress bar, and optionally a hash object, with the
+    bytes read from it.
+    """
+
+    def __init__(self, stream, pbar: tqdm, hash_obj=None):
+        self.stream = stream
+        self.pbar = pbar
+        self.hash_obj = hash_obj
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, b) -> int:
+        n = self.stream.readinto(b)
+        if n:
+            if self.hash_obj is not None:
+                self.hash_obj.update(memoryview(b)[:n])
+            self.pbar.update(n)
+        return n
+
+
 class Downloader:
     def __init__(self, config: Config, logger: Logger):
         self.base_url = config.rss_base_url
         self.archive_dir = config.archive_dir
         self.logger = logger
+        # Share one session between all requests (including across download threads) so that connections, and TLS
+        # sessions, to the catalogue and mirrors are reused
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=16, pool_maxsize=32, max_retries=Retry(total=3, backoff_factor=0.3))
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        # Results of searches already made, keyed by query parameters
+        self._search_cache: dict[tuple[tuple[str, str], ...], list[ArchiveEntry]] = {}
 
-    def _build_url(
-            self,
+    @staticmethod
+    def _params(
             lang: Optional[Collection[str]] = None,
             category: Optional[str] = None,
             query: Optional[str] = None
-    ) -> str:
-        params = {}
+    ) -> tuple[tuple[str, str], ...]:
+        """Build the query parameters for a search of the catalogue, as a tuple so that they can be used as a key."""
+        params = [("count", "-1")]
         if lang is not None:
-            params["lang"] = ",".join(lang)
+            params.append(("lang", ",".join(sorted(lang))))
         if category is not None:
-            params["category"] = category
+            params.append(("category", category))
         if query is not None:
-            params["q"] = query
-        return f"{self.base_url}?{urllib.parse.urlencode(params)}"
+            params.append(("q", query))
+        return tuple(params)
 
     def search(
             self,
@@ -53,41 +173,40 @@ class Downloader:
             category: Optional[str] = None,
             query: Optional[str] = None
     ) -> list[ArchiveEntry]:
-        params = {"count": "-1"}
-        if lang is not None:
-            params["lang"] = ",".join(lang)
-        if category is not None:
-            params["category"] = category
-        if query is not None:
-            params["q"] = query
-        result = requests.get(self.base_url, params)
-        self.logger.info(f"Queried URL {result.url}, status: {result.status_code}.")
-        result.raise_for_status()
-        xml = ET.fromstring(result.text)
-        entries = [ArchiveEntry.from_xml(e) for e in xml.findall("atom:entry", ENTRIES_NSMAP)]
+        params = self._params(lang, category, query)
+        if params in self._search_cache:
+            return list(self._search_cache[params])
+        entries = []
+        entry_tag = ATOM_PREFIX + "entry"
+        with self.session.get(self.base_url, params, stream=True) as result:
+            self.logger.info(f"Queried URL {result.url}, status: {result.status_code}.")
+            result.raise_for_status()
+            # Parse the raw bytes as they arrive, one entry at a time, rather than decoding and parsing the whole body
+            result.raw.decode_content = True
+            for _, elem in ET.iterparse(result.raw, events=("end",)):
+                if elem.tag == entry_tag:
+                    entries.append(ArchiveEntry.from_xml(elem))
+                    elem.clear()
         self.logger.info(f"Found {len(entries)} results.")
-        return entries
+        self._search_cache[params] = entries
+        return list(entries)
 
     def verify(self, fpath: str, hashes: dict[str, str]):
-        """Verify a file against one of the given hashes."""
-        if "sha-256" in hashes:
-            hash_fn = sha256
-            expected = hashes["sha-256"]
-        elif "sha-1" in hashes:
-            hash_fn = sha1
-            expected = hashes["sha-1"]
-        elif "md5" in hashes:
-            hash_fn = md5
-            expected = hashes["md5"]
-        else:
-            raise ValueError("No supported hash found.")
+        """Verify a file already on disk against one of the given hashes, raising `VerificationFailed` if it doesn't
+        match. Downloads are verified as they are written (see `try_mirror`), so this isn't used when downloading; it
+        is kept as a public method for re-checking archives that have already been downloaded.
+        """
+        algo, expected = choose_hash(hashes)
 
-        self.logger.info(f"Verifying file using {hash_fn.__name__} algorithm.")
+        self.logger.info(f"Verifying file using {algo} algorithm.")
 
         with open(fpath, "rb") as f:
-            h = hashlib.file_digest(f, hash_fn).hexdigest()
+            if hasattr(os, "posix_fadvise"):
+                os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+            # Use a much larger buffer than the default so that most of the time is spent hashing in C.
+            h = hashlib.file_digest(f, HASH_ALGORITHMS[algo], _bufsize=HASH_BUFSIZE).hexdigest()
         if h != expected:
-            raise VerificationFailed(f"File at {fpath} failed verification using {hash_fn.__name__} algorithm. "
+            raise VerificationFailed(f"File at {fpath} failed verification using {algo} algorithm. "
                                      f"Expected {expected} but got {h}")
 
 
@@ -96,42 +215,50 @@ class Downloader:
             dst_path: str,
             mirror: Mirror,
             meta: ArchiveMeta,
+            hash_algo: Optional[str] = None,
+            expected_hash: Optional[str] = None,
             check_length: bool = True,
             quiet: bool = False,
             pbar_position: Optional[int] = None
-    ):
-
-        if check_length:
-            head_response = requests.head(mirror.url)
-            head_response.raise_for_status()
-            if not ("Content-Length" in head_response.headers):
-                raise MirrorDownloadFailed("Could not get content length. Aborting download.")
-            size = int(head_response.headers["Content-Length"])
-            if psutil.disk_usage(self.archive_dir).free < size:
-                raise DownloadError("File would not fit on disk. Aborting download.")
-        else:
-            size = meta.size
+    ) -> str:
+        """Download a file from the given mirror to `dst_path`. If `hash_algo` is given, the file is hashed as it is
+        downloaded using that algorithm and checked against `expected_hash`. If the check fails, `VerificationFailed`
+        is raised before the file is moved into place at `dst_path`.
+        """
 
-        part_path = dst_path + ".part"
-        content_response = requests.get(mirror.url, stream=True)
-        if not content_response.ok:
-            raise MirrorDownloadFailed("Could not download content. Aborting.")
-
-        with tqdm(
-                total=size,
-                unit='B',
-                unit_scale=True,
-                desc=meta.file_name,
-                position=pbar_position,
-                leave=(pbar_position is None),  # Only leave traces if we're not in multithreaded environment
-                disable=quiet
-        ) as pb:
-            with open(part_path, 'wb') as f:
-                for chunk in content_response.iter_content(chunk_size=1024 * 1024):
-                    n = f.write(chunk)
-                    pb.update(n)
+        # The response is closed on leaving this block, so if we abort before reading the body it is never downloaded
+        with self.session.get(mirror.url, stream=True) as content_response:
+            if not content_response.ok:
+                raise MirrorDownloadFailed("Could not download content. Aborting.")
+            if check_length:
+                if not ("Content-Length" in content_response.headers):
+                    raise MirrorDownloadFailed("Could not get content length. Aborting download.")
+                size = int(content_response.headers["Content-Length"])
+                if psutil.disk_usage(self.archive_dir).free < size:
+                    raise DownloadError("File would not fit on disk. Aborting download.")
+            else:
+                size = meta.size
 
-        os.rename(part_path, dst_path)
+            h = HASH_ALGORITHMS[hash_algo]() if hash_algo is not None else None
+            with tqdm(
+                    total=size,
+                    unit='B',
+                    unit_scale=True,
+                    desc=meta.file_name,
+                    position=pbar_position,
+                    leave=(pbar_position is None),  # Only leave traces if we're not in multithreaded environment
+                    disable=quiet
+            ) as pb:
+                content_response.raw.decode_content = True
+                with open_for_download(dst_path) as f:
+                    shutil.copyfileobj(ProgressReader(content_response.raw, pb, h), f, COPY_BUFSIZE)
+                    if h is not None:
+                        digest = h.hexdigest()
+                        if digest != expected_hash:
+                            raise VerificationFailed(
+                                f"File downloaded from {mirror.url} failed verification using {hash_algo} "
+                                f"algorithm. Expected {expected_hash} but got {digest}"
+                            )
 
         return dst_path
 
@@ -143,14 +270,17 @@ class Downloader:
             quiet: bool = False,
             pbar_position: Optional[int] = None
     ) -> ArchiveDetails:
-        meta_xml = ET.fromstring(requests.get(entry.meta_link).text)
+        meta_xml = ET.fromstring(self.session.get(entry.meta_link).content)
         meta = ArchiveMeta.from_xml(meta_xml)
         dst = os.path.join(self.archive_dir, meta.file_name)
+        if verify:
+            algo, expected = choose_hash(meta.hashes)
+            self.logger.info(f"Will verify file using {algo} algorithm.")
+        else:
+            algo = expected = None
         for mirror in sorted(meta.mirrors, key=lambda m: m.priority):
             try:
-                dst_path = self.try_mirror(dst, mirror, meta, check_length, quiet, pbar_position)
-                if verify:
-                    self.verify(dst_path, meta.hashes)
+                self.try_mirror(dst, mirror, meta, algo, expected, check_length, quiet, pbar_position)
                 return ArchiveDetails(entry.to_reference(), entry.updated, meta.file_name)
             except MirrorDownloadFailed:
                 continue
@@ -170,6 +300,8 @@ class Downloader:
         tqdm.set_lock(RLock())
         # below is attempt to address https://github.com/tqdm/tqdm/issues/670 but doesn't seem to work...
         posn_range = range(1, len(entries) + 1)
+        # Each archive is hashed in its worker thread as it downloads. hashlib releases the GIL while hashing large
+        # blocks, so hashing of concurrent downloads is spread across cores without needing a process pool.
         with ThreadPoolExecutor(initializer=tqdm.set_lock, initargs=(tqdm.get_lock(),)) as p:
             return list(p.map(
                 lambda e, posn: self.download_archive(e, verify, check_length, quiet, posn),
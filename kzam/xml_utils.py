@@ -1,2 +1,5 @@
 ENTRIES_NSMAP = {"atom": "http://www.w3.org/2005/Atom"}
-META_NSMAP = {"metalink": "urn:ietf:params:xml:ns:metalink"}
\ No newline at end of file
+META_NSMAP = {"metalink": "urn:ietf:params:xml:ns:metalink"}
+
+# Prefix of tag names in the Atom namespace, as they appear on parsed elements
+ATOM_PREFIX = f"{{{ENTRIES_NSMAP['atom']}}}"
@@ -0,0 +1,46 @@
+import xml.etree.ElementTree as ET
+from datetime import datetime, timezone
+
+from kzam.datamodel import ArchiveEntry
+
+ENTRY_XML = """
+<entry xmlns="http://www.w3.org/2005/Atom" xmlns:dc="http://purl.org/dc/terms/">
+    <id>urn:uuid:0a1b2c3d</id>
+    <title>Arch Linux Wiki</title>
+    <updated>2024-01-01T00:00:00Z</updated>
+    <summary>Arch Linux documentation</summary>
+    <language>eng,fra</language>
+    <name>archlinux_en_all</name>
+    <flavour/>
+    <category>other</category>
+    <tags>_ftindex:yes;_pictures:yes</tags>
+    <articleCount>10</articleCount>
+    <mediaCount>2</mediaCount>
+    <author><name>Arch Linux</name></author>
+    <publisher><name>openZIM</name></publisher>
+    <dc:issued>2024-01-02T00:00:00Z</dc:issued>
+    <link rel="alternate" type="text/html" href="/viewer#archlinux_en_all"/>
+    <link rel="http://opds-spec.org/acquisition/open-access" type="application/x-zim"
+          href="https://download.kiwix.org/zim/other/archlinux_en_all.zim.meta4"/>
+</entry>
+"""
+
+
+def test_entry_from_xml():
+    entry = ArchiveEntry.from_xml(ET.fromstring(ENTRY_XML))
+    assert entry == ArchiveEntry(
+        id="urn:uuid:0a1b2c3d",
+        title="Arch Linux Wiki",
+        updated=datetime(2024, 1, 1, tzinfo=timezone.utc),
+        summary="Arch Linux documentation",
+        language=frozenset({"eng", "fra"}),
+        name="archlinux_en_all",
+        flavor=None,
+        category="other",
+        tags=frozenset({"_ftindex:yes", "_pictures:yes"}),
+        article_count=10,
+        media_count=2,
+        author_name="Arch Linux",
+        publisher_name="openZIM",
+        meta_link="https://download.kiwix.org/zim/other/archlinux_en_all.zim.meta4"
+    )
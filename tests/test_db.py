@@ -0,0 +1,43 @@
+from datetime import datetime, timezone
+
+from kzam.datamodel import ArchiveReference, ArchiveDetails
+from kzam.db import DbManager
+
+
+def test_insert_archives_replaces_older_versions():
+    db = DbManager(":memory:")
+    tracked = ArchiveReference("archlinux_en_all", frozenset({"eng"}), "maxi")
+    unflavoured = ArchiveReference("wikipedia_fr_all", frozenset({"fra"}), None)
+    new = ArchiveReference("gutenberg_en_all", frozenset({"eng"}), None)
+    old_date = datetime(2024, 1, 1, tzinfo=timezone.utc)
+    new_date = datetime(2024, 6, 1, tzinfo=timezone.utc)
+    db.insert_archives([
+        ArchiveDetails(tracked, old_date, "archlinux_old.zim"),
+        ArchiveDetails(unflavoured, old_date, "wikipedia_old.zim"),
+    ])
+    superseded = db.insert_archives([
+        ArchiveDetails(new, new_date, "gutenberg.zim"),
+        ArchiveDetails(tracked, new_date, "archlinux_new.zim"),
+        ArchiveDetails(unflavoured, new_date, "wikipedia_new.zim"),
+    ])
+    assert sorted(superseded, key=lambda a: a.file_name) == [
+        ArchiveDetails(tracked, old_date, "archlinux_old.zim"),
+        ArchiveDetails(unflavoured, old_date, "wikipedia_old.zim"),
+    ]
+    actual = {a.file_name: a.updated for a in db.all_archives()}
+    assert actual == {
+        "gutenberg.zim": new_date,
+        "archlinux_new.zim": new_date,
+        "wikipedia_new.zim": new_date,
+    }
+
+
+def test_delete_archives():
+    db = DbManager(":memory:")
+    updated = datetime(2024, 1, 1, tzinfo=timezone.utc)
+    flavoured = ArchiveDetails(ArchiveReference("archlinux_en_all", frozenset({"eng"}), "maxi"), updated, "a.zim")
+    unflavoured = ArchiveDetails(ArchiveReference("wikipedia_fr_all", frozenset({"fra"}), None), updated, "w.zim")
+    kept = ArchiveDetails(ArchiveReference("gutenberg_en_all", frozenset({"eng"}), None), updated, "g.zim")
+    db.insert_archives([flavoured, unflavoured, kept])
+    db.delete_archives([flavoured, unflavoured])
+    assert db.all_archives() == [kept]
@@ -2,10 +2,12 @@ import os
 import xml.etree.ElementTree as ET
 from shutil import rmtree
 
+import pytest
+
 import requests
 
 from kzam import Config
-from kzam.download import Downloader
+from kzam.download import Downloader, open_for_download
 from kzam.xml_utils import ENTRIES_NSMAP
 
 TEST_DATA_DIR = "test_data"
@@ -39,4 +41,44 @@ def test_02_download():
     for a in archives:
         dst_path = downloader.download_archive(a, True)
         assert dst_path.endswith(f".zim")
-        assert os.path.isfile(dst_path)
\ No newline at end of file
+        assert os.path.isfile(dst_path)
+
+
+@pytest.fixture(params=["tmpfile", "part"])
+def download_method(request, monkeypatch):
+    """Run a test both with O_TMPFILE (where supported) and with the ".part" file fallback."""
+    if request.param == "part":
+        monkeypatch.delattr(os, "O_TMPFILE", raising=False)
+    elif not hasattr(os, "O_TMPFILE"):
+        pytest.skip("O_TMPFILE not supported on this platform")
+    return request.param
+
+def test_03_open_for_download_new(tmp_path, download_method):
+    dst_path = tmp_path / "archive.zim"
+    with open_for_download(str(dst_path)) as f:
+        f.write(b"content")
+    assert dst_path.read_bytes() == b"content"
+    assert os.listdir(tmp_path) == ["archive.zim"]
+
+def test_04_open_for_download_overwrite(tmp_path, download_method):
+    dst_path = tmp_path / "archive.zim"
+    dst_path.write_bytes(b"old content")
+    with open_for_download(str(dst_path)) as f:
+        f.write(b"new content")
+    assert dst_path.read_bytes() == b"new content"
+    assert os.listdir(tmp_path) == ["archive.zim"]
+
+def test_05_open_for_download_exception(tmp_path, download_method):
+    dst_path = tmp_path / "archive.zim"
+    dst_path.write_bytes(b"old content")
+    with pytest.raises(RuntimeError):
+        with open_for_download(str(dst_path)) as f:
+            f.write(b"partial content")
+            raise RuntimeError
+    assert dst_path.read_bytes() == b"old content"
+    assert os.listdir(tmp_path) == ["archive.zim"]
+    with pytest.raises(FileNotFoundError) as exc_info:
+        with open_for_download(str(tmp_path / "missing" / "archive.zim")):
+            pass
+    # The original error should be raised, not one from trying to clean up after it
+    assert exc_info.value.__context__ is None
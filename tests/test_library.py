@@ -0,0 +1,24 @@
+from kzam import parse_zim_ids
+
+SHOW_OUTPUT = (
+    b"#0\n"
+    b"id:\t\t0a1b2c3d-0000-0000-0000-000000000000\n"
+    b"path:\t\t/srv/kiwix/archives/my archive.zim\n"
+    b"url:\t\t\n"
+    b"title:\t\tMy Archive\n"
+    b"#1\r\n"
+    b"id:\t\t4e5f6a7b-0000-0000-0000-000000000000\r\n"
+    b"path:\t\t/srv/kiwix/archives/other.zim\r\n"
+    b"url:\r\n"
+)
+
+
+def test_parse_zim_ids():
+    assert parse_zim_ids(SHOW_OUTPUT) == {
+        "/srv/kiwix/archives/my archive.zim": "0a1b2c3d-0000-0000-0000-000000000000",
+        "/srv/kiwix/archives/other.zim": "4e5f6a7b-0000-0000-0000-000000000000",
+    }
+
+
+def test_parse_zim_ids_empty():
+    assert parse_zim_ids(b"") == {}